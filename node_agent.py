@@ -4,15 +4,36 @@ Node Agent - Manages Xray node and communicates with main server
 """
 import asyncio
 import aiohttp
-import json
+import grpc
+import gzip
+import orjson
 import os
-import tempfile
-import subprocess
 import psutil
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional, Set
-from xtlsapi import XrayClient
+import random
+import signal
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+from xtlsapi.ext.utils import to_typed_message
+from xtlsapi.xray_api.app.proxyman.command import command_pb2 as handler_pb2
+from xtlsapi.xray_api.app.proxyman.command import command_pb2_grpc as handler_pb2_grpc
+from xtlsapi.xray_api.app.stats.command import command_pb2 as stats_pb2
+from xtlsapi.xray_api.app.stats.command import command_pb2_grpc as stats_pb2_grpc
+from xtlsapi.xray_api.common.protocol import user_pb2
+from xtlsapi.xray_api.proxy.vless import account_pb2 as vless_account_pb2
+
+try:
+    import uvloop  # optional: faster event loop, stock asyncio otherwise
+except ImportError:
+    uvloop = None
+
+try:
+    # optional: restart Xray over the systemd D-Bus API instead of forking systemctl
+    from dbus_next import BusType
+    from dbus_next.aio import MessageBus
+except ImportError:
+    MessageBus = None
 
 # Configure logging
 logging.basicConfig(
@@ -22,9 +43,120 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Note: Xray CLI doesn't provide direct commands for adding/removing individual users
-# The API commands adi/rmi work with entire inbounds, not individual users
-# We use immediate reload after config changes instead of batching
+# Per-user traffic stat names: user>>>UUID>>>traffic>>>uplink|downlink
+USER_STAT_PREFIX = 'user>>>'
+TRAFFIC_STAT_INFIX = '>>>traffic>>>'
+
+# Xray stat direction -> index into per-user [upload, download] counters
+TRAFFIC_DIRECTIONS = {'uplink': 0, 'downlink': 1}
+
+# Max concurrent gRPC add/remove calls during a user sync batch
+GRPC_CONCURRENCY = 16
+
+# Delay (seconds) before cached config changes are flushed to disk
+CONFIG_FLUSH_DELAY = 0.1
+# Delay (seconds) before a failed flush is retried
+CONFIG_FLUSH_RETRY_DELAY = 5
+
+
+# Max main server requests in flight at once, across all loops
+MAX_INFLIGHT_REQUESTS = 4
+
+# Traffic POST bodies above this size (bytes) are sent gzip-compressed
+# when TRAFFIC_GZIP is enabled
+GZIP_MIN_SIZE = 1024
+
+# Timeouts (seconds) for external commands; a hung command is killed
+CLI_TIMEOUT = 5
+RESTART_TIMEOUT = 30
+
+# Deadline (seconds) for Xray gRPC API calls
+GRPC_TIMEOUT = 5
+
+# systemd unit restarted over D-Bus
+XRAY_UNIT = "xray.service"
+
+# Xray restart commands: via the host PID namespace first, then directly
+NSENTER_RESTART_CMD = ("nsenter", "-t", "1", "-m", "-u", "-i", "-n", "systemctl", "restart", "xray")
+SYSTEMCTL_RESTART_CMD = ("systemctl", "restart", "xray")
+
+# Every Nth user sync ignores the stored ETag and diffs the full user list
+USERS_FULL_SYNC_EVERY = 12
+
+# Upper bound (seconds) for retry delay after consecutive loop failures
+MAX_BACKOFF = 300
+
+# Main server connection errors: propagated to the loops for backoff
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def parse_user_stat_name(name: str) -> Optional[Tuple[str, int]]:
+    """
+    Parse user>>>UUID>>>traffic>>>uplink|downlink into (uuid, direction index)
+
+    Sliced around one find - no intermediate list of parts. Returns None for
+    any other stat name.
+    """
+    if not name.startswith(USER_STAT_PREFIX):
+        return None
+
+    uuid_end = name.find(TRAFFIC_STAT_INFIX, len(USER_STAT_PREFIX))
+    if uuid_end < 0:
+        return None
+
+    index = TRAFFIC_DIRECTIONS.get(name[uuid_end + len(TRAFFIC_STAT_INFIX):])
+    if index is None:
+        return None
+
+    return name[len(USER_STAT_PREFIX):uuid_end], index
+
+
+def utc_now() -> datetime:
+    """Current UTC time as a naive datetime (the format the main server expects)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def jittered(interval: float, spread: float = 0.1) -> float:
+    """Randomize a loop interval by +/-spread so periodic ticks don't align"""
+    return interval * random.uniform(1 - spread, 1 + spread)
+
+
+def backoff(interval: float, failures: int) -> float:
+    """Retry delay after `failures` consecutive errors: exponential, capped, jittered"""
+    return min(interval * 2 ** (failures - 1), MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+
+def grpc_error(e: Exception) -> str:
+    """Short description of a failed gRPC call: status code and details"""
+    if isinstance(e, grpc.Call):
+        return f"{e.code().name}: {e.details()}"
+    return str(e)
+
+
+def collect_system_stats() -> Tuple[float, float]:
+    """Blocking psutil reads for the health check: (cpu_percent, memory_percent)"""
+    return psutil.cpu_percent(None), psutil.virtual_memory().percent
+
+
+async def run_command(cmd, timeout: float) -> Tuple[int, bytes, bytes]:
+    """
+    Run an external command, returns (returncode, stdout, stderr).
+
+    Raises asyncio.TimeoutError if it doesn't finish within timeout seconds;
+    the process is killed and reaped so no zombie is left behind.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout, stderr
 
 
 class XrayConfigManager:
@@ -32,149 +164,314 @@ class XrayConfigManager:
 
     def __init__(self, config_path: str = "/usr/local/etc/xray/config.json"):
         self.config_path = config_path
-        # Initialize gRPC client for zero-downtime user management
+        # gRPC channel to the Xray API for zero-downtime user management
         self.xray_api_host = os.getenv('XRAY_API_HOST', '127.0.0.1')
         self.xray_api_port = int(os.getenv('XRAY_API_PORT', '10085'))
-        self.xray_client = XrayClient(self.xray_api_host, self.xray_api_port)
+        self.xray_channel = grpc.insecure_channel(f"{self.xray_api_host}:{self.xray_api_port}")
+        self._handler_stub = handler_pb2_grpc.HandlerServiceStub(self.xray_channel)
+        # Bounds concurrent gRPC calls across add/remove batches
+        self._grpc_semaphore = asyncio.Semaphore(GRPC_CONCURRENCY)
+        # Serializes config read-modify-write between concurrent batches
+        self._config_lock = asyncio.Lock()
+
+        # In-memory config cache with write-back: write_config() only marks
+        # it dirty, flush() persists it (debounced by CONFIG_FLUSH_DELAY)
+        self._cache: Optional[dict] = None
+        self._cache_stat: Tuple[int, int] = (0, 0)  # (mtime_ns, size) of the cached file
+        self._dirty = False
+        self._generation = 0  # bumped by every write_config()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_error: Optional[Exception] = None  # set while the last flush failed
+        # Bumped when the cache is (re)loaded from disk or a flush fails, i.e.
+        # whenever users may differ from what the last sync applied
+        self.epoch = 0
+
+        # Tag -> inbound / tag -> client ids of the cached config, rebuilt
+        # whenever a different config object is loaded or written
+        self._indexed_config: Optional[dict] = None
+        self._inbound_index: Dict[str, dict] = {}
+        self._client_ids: Dict[str, Set[str]] = {}
+
+        # Set by config changes only a restart applies, cleared by reload_xray
+        self.config_needs_reload = False
 
     async def read_config(self) -> dict:
-        """Read Xray configuration"""
+        """
+        Read Xray configuration
+
+        Served from the in-memory cache while it has unflushed changes or the
+        file on disk is unchanged. The returned dict is the live cached
+        object: mutate it in place and pass it back to write_config().
+        """
         try:
-            with open(self.config_path, 'r') as f:
-                return json.load(f)
+            if self._cache is not None and (
+                self._dirty or self._file_stat() == self._cache_stat
+            ):
+                return self._cache
+
+            # File I/O runs in a worker thread to keep the event loop free
+            file_stat, data = await asyncio.to_thread(self._read_file)
+            self._cache = orjson.loads(data)
+            self._cache_stat = file_stat
+            self.epoch += 1
+            return self._cache
         except Exception as e:
             logger.error(f"Failed to read config: {e}")
             return {}
 
     async def write_config(self, config: dict) -> bool:
-        """Write Xray configuration"""
-        try:
-            with open(self.config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"Failed to write config: {e}")
-            return False
-
-    async def get_inbound_users(self, inbound_tag: str) -> Set[str]:
-        """Get list of user UUIDs in an inbound"""
-        config = await self.read_config()
-        inbounds = config.get('inbounds', [])
-
-        for inbound in inbounds:
-            if inbound.get('tag') == inbound_tag:
-                clients = inbound.get('settings', {}).get('clients', [])
-                return {client.get('id') for client in clients if client.get('id')}
+        """
+        Write Xray configuration
 
-        return set()
+        Updates the cache and schedules a flush to disk; several writes in
+        quick succession are coalesced into one.
 
-    async def add_user(self, inbound_tag: str, user_uuid: str, email: str = "") -> bool:
+        Returns:
+            False if the last flush failed: the change is kept in the cache
+            and flushed by the retry, but isn't on disk yet
         """
-        Add user with zero-downtime via gRPC API + persist to config file.
+        self._cache = config
+        self._dirty = True
+        self._generation += 1
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(
+            CONFIG_FLUSH_DELAY, self._schedule_flush
+        )
+        return self._flush_error is None
 
-        Uses xtlsapi library for direct gRPC calls to Xray (like Marzban does).
-        First adds to runtime for immediate activation, then persists to config.
+    def _schedule_flush(self):
+        """Timer callback: run flush() as a task"""
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self.flush())
 
-        NOTE: With XHTTP transport, flow parameter is NOT used. It was required
-        only for TCP+Vision transport which is now blocked by RKN (Nov 2025).
-        """
-        try:
-            email = email or user_uuid
+    async def flush(self) -> bool:
+        """Persist pending config changes to disk"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
 
-            # STEP 1: Add to runtime via gRPC (zero-downtime)
-            # NOTE: For XHTTP transport, flow should NOT be set
             try:
-                # add_client(inbound_tag, uuid, user_email, protocol)
-                # No flow parameter for XHTTP!
-                user = self.xray_client.add_client(
-                    inbound_tag,
-                    user_uuid,
-                    email,
-                    'vless'
-                )
-                if not user:
-                    logger.error(f"Failed to add user {email} via gRPC")
-                    return False
+                # Serialize on the loop (consistent snapshot), write in a thread
+                generation = self._generation
+                data = orjson.dumps(self._cache, option=orjson.OPT_INDENT_2)
+                self._cache_stat = await asyncio.to_thread(self._write_file, data)
+                # Stay dirty if write_config() ran while the file was written
+                if self._generation == generation:
+                    self._dirty = False
+                self._flush_error = None
+                return True
             except Exception as e:
-                logger.error(f"gRPC add_client failed: {e}")
+                logger.error(f"Failed to write config: {e}, retrying in {CONFIG_FLUSH_RETRY_DELAY}s")
+                self._flush_error = e
+                self.epoch += 1
+                if self._flush_handle is None:
+                    self._flush_handle = asyncio.get_running_loop().call_later(
+                        CONFIG_FLUSH_RETRY_DELAY, self._schedule_flush
+                    )
                 return False
 
-            # STEP 2: Update config file (for persistence)
-            config = await self.read_config()
-            inbounds = config.get('inbounds', [])
+    def _inbound(self, config: dict, inbound_tag: str) -> Optional[dict]:
+        """Look up an inbound of config by tag"""
+        if config is not self._indexed_config:
+            self._inbound_index = {}
+            self._client_ids = {}
+            for inbound in config.get('inbounds', []):
+                tag = inbound.get('tag')
+                clients = inbound.get('settings', {}).get('clients', [])
+                self._inbound_index[tag] = inbound
+                self._client_ids[tag] = {c.get('id') for c in clients if c.get('id')}
+            self._indexed_config = config
+        return self._inbound_index.get(inbound_tag)
+
+    def _file_stat(self) -> Tuple[int, int]:
+        """(mtime_ns, size) of the config file, to detect external changes"""
+        st = os.stat(self.config_path)
+        return st.st_mtime_ns, st.st_size
+
+    def _read_file(self) -> Tuple[Tuple[int, int], bytes]:
+        """Blocking read of the config file, returns (file stat, contents)"""
+        file_stat = self._file_stat()
+        with open(self.config_path, 'rb') as f:
+            return file_stat, f.read()
+
+    def _write_file(self, data: bytes) -> Tuple[int, int]:
+        """
+        Blocking atomic write of the config file, returns its new stat
 
-            for inbound in inbounds:
-                if inbound.get('tag') == inbound_tag:
-                    clients = inbound.get('settings', {}).get('clients', [])
+        Writes a temp file next to it and renames it over the original, so a
+        crash mid-write never leaves Xray a truncated config.
+        """
+        tmp_path = self.config_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
 
-                    # Check if user already in config
-                    if any(c.get('id') == user_uuid for c in clients):
-                        logger.info(f"✓ Added user {email} to runtime (already in config)")
-                        return True
+        # Keep the original mode/owner so the host Xray service can still read it
+        try:
+            st = os.stat(self.config_path)
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except FileNotFoundError:
+            pass
+        except PermissionError as e:
+            logger.warning(f"Could not preserve config file ownership: {e}")
+
+        os.replace(tmp_path, self.config_path)
+
+        # Persist the rename itself
+        dir_fd = os.open(os.path.dirname(self.config_path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
-                    # Add to config (no flow for XHTTP transport)
-                    clients.append({
-                        "id": user_uuid,
-                        "email": email,
-                        "level": 0
-                    })
+        return self._file_stat()
 
-                    if await self.write_config(config):
-                        logger.info(f"✓ Added user {email} (runtime + config, zero-downtime)")
-                        return True
-                    else:
-                        logger.warning(f"Added to runtime but config save failed")
-                        return True  # User still works, just not persisted
+    async def get_inbound_users(self, inbound_tag: str) -> Set[str]:
+        """Get list of user UUIDs in an inbound"""
+        config = await self.read_config()
+        if self._inbound(config, inbound_tag) is None:
+            return set()
+        # Copy: the index set is updated in place by add/remove
+        return set(self._client_ids[inbound_tag])
 
-            logger.error(f"Inbound {inbound_tag} not found")
-            return False
+    async def add_user(self, inbound_tag: str, user_uuid: str, email: str = "") -> bool:
+        """Add a single user with zero-downtime (see apply_user_diff)"""
+        return await self.add_users(inbound_tag, [(user_uuid, email or user_uuid)]) == 1
 
-        except Exception as e:
-            logger.error(f"Error adding user: {e}")
-            return False
+    async def add_users(self, inbound_tag: str, users: List[Tuple[str, str]]) -> int:
+        """Add users with zero-downtime (see apply_user_diff), returns number added"""
+        added, _ = await self.apply_user_diff(inbound_tag, users, [])
+        return added
 
     async def remove_user(self, inbound_tag: str, user_uuid: str) -> bool:
+        """Remove a single user with zero-downtime (see apply_user_diff)"""
+        return await self.remove_users(inbound_tag, [user_uuid]) == 1
+
+    async def remove_users(self, inbound_tag: str, user_uuids: List[str]) -> int:
+        """Remove users with zero-downtime (see apply_user_diff), returns number removed"""
+        _, removed = await self.apply_user_diff(inbound_tag, [], user_uuids)
+        return removed
+
+    async def apply_user_diff(
+        self,
+        inbound_tag: str,
+        users_to_add: List[Tuple[str, str]],
+        user_uuids_to_remove: List[str]
+    ) -> Tuple[int, int]:
         """
-        Remove user with zero-downtime via gRPC API + remove from config.
+        Add and remove users with zero-downtime via gRPC API + persist to config file.
 
-        Uses xtlsapi library for direct gRPC calls to Xray (like Marzban does).
-        First removes from runtime for immediate effect, then updates config.
-        """
-        try:
-            user_email = user_uuid
+        Uses the xtlsapi protobuf stubs for direct gRPC calls to Xray (like
+        Marzban does), each with a GRPC_TIMEOUT deadline.
+        First applies every change to runtime for immediate effect (calls run
+        concurrently, at most GRPC_CONCURRENCY at a time across all batches),
+        then persists the whole diff with a single config read-modify-write.
 
-            # STEP 1: Remove from runtime via gRPC (zero-downtime)
-            try:
-                # remove_client(inbound_tag, user_email)
-                self.xray_client.remove_client(inbound_tag, user_email)
-            except Exception as e:
-                logger.warning(f"gRPC remove_client failed (user may not exist): {e}")
+        NOTE: With XHTTP transport, flow parameter is NOT used. It was required
+        only for TCP+Vision transport which is now blocked by RKN (Nov 2025).
 
-            # STEP 2: Remove from config file (for persistence)
-            config = await self.read_config()
-            inbounds = config.get('inbounds', [])
+        Args:
+            inbound_tag: Xray inbound tag
+            users_to_add: List of (uuid, email) pairs
+            user_uuids_to_remove: UUIDs (= emails) of users to remove
 
-            for inbound in inbounds:
-                if inbound.get('tag') == inbound_tag:
-                    clients = inbound.get('settings', {}).get('clients', [])
-                    original_count = len(clients)
+        Returns:
+            (added, removed): users added to runtime and (if inbound found)
+            config, users removed
+        """
+        if not users_to_add and not user_uuids_to_remove:
+            return 0, 0
 
-                    clients[:] = [c for c in clients if c.get('id') != user_uuid]
+        try:
+            # STEP 1: Apply to runtime via gRPC (zero-downtime)
+            # Email is the user UUID (see NodeAgent.sync_users)
+            results = await asyncio.gather(
+                *(self._add_runtime(inbound_tag, u, e) for u, e in users_to_add),
+                *(self._remove_runtime(inbound_tag, u) for u in user_uuids_to_remove)
+            )
+            added = [user for user, ok in zip(users_to_add, results) if ok]
+            removed = len(user_uuids_to_remove)
+
+            # STEP 2: Update config file once for the whole diff (for persistence)
+            async with self._config_lock:
+                config = await self.read_config()
+                inbound = self._inbound(config, inbound_tag)
+                if inbound is None:
+                    logger.error(f"Inbound {inbound_tag} not found")
+                    return 0, removed
+
+                clients = inbound.setdefault('settings', {}).setdefault('clients', [])
+                existing = self._client_ids[inbound_tag]
+                changed = False
+
+                to_remove = set(user_uuids_to_remove)
+                if not existing.isdisjoint(to_remove):
+                    clients[:] = [c for c in clients if c.get('id') not in to_remove]
+                    existing -= to_remove
+                    changed = True
+
+                # Add to config (no flow for XHTTP transport)
+                for user_uuid, email in added:
+                    if user_uuid not in existing:
+                        existing.add(user_uuid)
+                        clients.append({"id": user_uuid, "email": email, "level": 0})
+                        changed = True
+
+                if changed and not await self.write_config(config):
+                    # Changes still apply at runtime, persisted once a flush retry succeeds
+                    logger.warning(f"Applied +{len(added)}/-{removed} user(s) to runtime but config save is failing")
+                else:
+                    logger.debug(
+                        "Applied +%d/-%d user(s) (%s, zero-downtime)",
+                        len(added), removed, 'runtime + config' if changed else 'runtime only'
+                    )
+                return len(added), removed
 
-                    if len(clients) < original_count:
-                        if await self.write_config(config):
-                            logger.info(f"✓ Removed user {user_email} (runtime + config, zero-downtime)")
-                            return True
-                        else:
-                            logger.warning(f"Removed from runtime but config save failed")
-                            return True
+        except Exception as e:
+            logger.error(f"Error applying user changes: {e}")
+            return 0, 0
 
-            logger.info(f"✓ Removed user {user_email} from runtime")
+    async def _add_runtime(self, inbound_tag: str, user_uuid: str, email: str) -> bool:
+        """Add one user to the running Xray via gRPC"""
+        async with self._grpc_semaphore:
+            try:
+                # No flow parameter for XHTTP!
+                account = vless_account_pb2.Account(id=user_uuid, encryption="none")
+                operation = handler_pb2.AddUserOperation(
+                    user=user_pb2.User(email=email, account=to_typed_message(account))
+                )
+                await asyncio.to_thread(self._alter_inbound, inbound_tag, operation)
+            except Exception as e:
+                logger.error(f"gRPC add_client failed for {email}: {grpc_error(e)}")
+                return False
             return True
 
-        except Exception as e:
-            logger.error(f"Error removing user: {e}")
-            return False
+    async def _remove_runtime(self, inbound_tag: str, user_email: str) -> bool:
+        """Remove one user from the running Xray via gRPC"""
+        async with self._grpc_semaphore:
+            try:
+                operation = handler_pb2.RemoveUserOperation(email=user_email)
+                await asyncio.to_thread(self._alter_inbound, inbound_tag, operation)
+            except Exception as e:
+                logger.warning(f"gRPC remove_client failed for {user_email} (user may not exist): {grpc_error(e)}")
+            return True
+
+    def _alter_inbound(self, inbound_tag: str, operation):
+        """Blocking AlterInbound call (add/remove user operation) with a deadline"""
+        self._handler_stub.AlterInbound(
+            handler_pb2.AlterInboundRequest(tag=inbound_tag, operation=to_typed_message(operation)),
+            timeout=GRPC_TIMEOUT
+        )
 
     async def reload_xray(self) -> bool:
         """
@@ -183,25 +480,36 @@ class XrayConfigManager:
         Note: Xray doesn't support graceful reload via SIGHUP. We use restart which
         causes ~1-2s downtime, but this happens max once per 3 minutes (batched changes).
         """
+        # Xray reads the file on start - make sure cached changes are on disk
+        if not await self.flush():
+            logger.error("Not restarting Xray: pending config changes could not be saved")
+            return False
+
+        # Preferred: ask host systemd directly and wait for the restart job
+        if MessageBus is not None:
+            try:
+                result = await self._restart_via_dbus()
+            except Exception as e:
+                logger.warning(f"D-Bus restart failed ({e!r}), trying nsenter...")
+            else:
+                if result == 'done':
+                    self.config_needs_reload = False
+                    logger.info("✓ Restarted Xray via systemd D-Bus (~1-2s downtime)")
+                    return True
+                if result is None:
+                    # The job is still queued - another restart would only pile up
+                    logger.error(f"Xray restart job didn't finish within {RESTART_TIMEOUT}s")
+                    return False
+                logger.warning(f"Xray restart job over D-Bus ended with '{result}', trying nsenter...")
+
         try:
             # Use nsenter to execute systemctl on host from Docker container
             # This works with privileged: true and pid: host
 
             # Method 1: Try nsenter to host PID namespace
-            cmd = [
-                "nsenter", "-t", "1", "-m", "-u", "-i", "-n",
-                "systemctl", "restart", "xray"
-            ]
-
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-
-            stdout, stderr = await process.communicate()
+            returncode, stdout, stderr = await run_command(NSENTER_RESTART_CMD, RESTART_TIMEOUT)
 
-            if process.returncode == 0:
+            if returncode == 0:
                 self.config_needs_reload = False
                 logger.info("✓ Restarted Xray via nsenter systemctl (~1-2s downtime)")
                 # Wait a bit for Xray to fully start
@@ -210,17 +518,9 @@ class XrayConfigManager:
             else:
                 # Fallback: Try direct systemctl
                 logger.warning("nsenter failed, trying direct systemctl...")
-                cmd = ["systemctl", "restart", "xray"]
+                returncode, stdout, stderr = await run_command(SYSTEMCTL_RESTART_CMD, RESTART_TIMEOUT)
 
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-
-                stdout, stderr = await process.communicate()
-
-                if process.returncode == 0:
+                if returncode == 0:
                     self.config_needs_reload = False
                     logger.info("✓ Restarted Xray via systemctl (~1-2s downtime)")
                     await asyncio.sleep(2)
@@ -230,10 +530,67 @@ class XrayConfigManager:
                     logger.error(f"Failed to restart Xray: {error_msg}")
                     return False
 
+        except asyncio.TimeoutError:
+            logger.error(f"Restarting Xray timed out after {RESTART_TIMEOUT}s")
+            return False
         except Exception as e:
             logger.error(f"Error reloading Xray: {e}")
             return False
 
+    async def _restart_via_dbus(self) -> Optional[str]:
+        """
+        Restart XRAY_UNIT through org.freedesktop.systemd1.Manager
+
+        Waits for the JobRemoved signal of the restart job instead of a fixed
+        sleep. Needs the host system bus socket mounted into the container.
+        The whole exchange is bounded by RESTART_TIMEOUT (dbus-next calls
+        have no timeout of their own).
+
+        Returns:
+            Result of the restart job ('done' on success), None if the job
+            was queued but didn't finish in time
+
+        Raises:
+            asyncio.TimeoutError (or a D-Bus error) if the job couldn't be queued
+        """
+        bus = None
+        # Results of finished jobs; the job may finish before its path is known
+        results: Dict[str, str] = {}
+        job_done = asyncio.Event()
+        job_path: Optional[str] = None
+
+        def on_job_removed(job_id: int, job: str, unit: str, result: str):
+            results[job] = result
+            if job == job_path:
+                job_done.set()
+
+        async def restart() -> str:
+            nonlocal bus, job_path
+            # Assigned before connecting so a timed-out connect is closed too
+            bus = MessageBus(bus_type=BusType.SYSTEM)
+            await bus.connect()
+            introspection = await bus.introspect('org.freedesktop.systemd1', '/org/freedesktop/systemd1')
+            proxy = bus.get_proxy_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1', introspection)
+            manager = proxy.get_interface('org.freedesktop.systemd1.Manager')
+
+            manager.on_job_removed(on_job_removed)
+            await manager.call_subscribe()  # systemd only emits job signals to subscribers
+
+            job_path = await manager.call_restart_unit(XRAY_UNIT, 'replace')
+            if job_path not in results:
+                await job_done.wait()
+            return results[job_path]
+
+        try:
+            return await asyncio.wait_for(restart(), RESTART_TIMEOUT)
+        except asyncio.TimeoutError:
+            if job_path is None:
+                raise
+            return None
+        finally:
+            if bus is not None:
+                bus.disconnect()
+
     async def validate_and_fix_config(self) -> bool:
         """
         Validate Xray configuration and fix common issues.
@@ -246,47 +603,48 @@ class XrayConfigManager:
             True if config was modified and fixed, False if no changes needed
         """
         try:
-            config = await self.read_config()
-            inbounds = config.get('inbounds', [])
-            config_modified = False
-            fixed_clients = []
-
-            for inbound in inbounds:
-                # Only validate VLESS inbounds
-                if inbound.get('protocol') != 'vless':
-                    continue
-
-                inbound_tag = inbound.get('tag', 'unknown')
-                stream_settings = inbound.get('streamSettings', {})
-                network = stream_settings.get('network', 'tcp')
-                clients = inbound.get('settings', {}).get('clients', [])
+            async with self._config_lock:
+                config = await self.read_config()
+                inbounds = config.get('inbounds', [])
+                config_modified = False
+                fixed_clients = []
+
+                for inbound in inbounds:
+                    # Only validate VLESS inbounds
+                    if inbound.get('protocol') != 'vless':
+                        continue
+
+                    inbound_tag = inbound.get('tag', 'unknown')
+                    stream_settings = inbound.get('streamSettings', {})
+                    network = stream_settings.get('network', 'tcp')
+                    clients = inbound.get('settings', {}).get('clients', [])
 
-                # For XHTTP transport - remove flow parameter from all clients
-                if network == 'xhttp':
-                    for client in clients:
-                        client_id = client.get('id', 'unknown')
-                        client_email = client.get('email', client_id)
-
-                        # Remove flow parameter if present (XHTTP doesn't use it)
-                        if 'flow' in client:
-                            del client['flow']
-                            config_modified = True
-                            fixed_clients.append(f"{client_email} ({client_id[:8]}...) - removed flow")
-                            logger.info(f"✓ Removed 'flow' parameter from user {client_email} in {inbound_tag} (not needed for XHTTP)")
-
-            # Write config if modified
-            if config_modified:
-                if await self.write_config(config):
-                    logger.info(f"✓ Config validation complete: Fixed {len(fixed_clients)} client(s)")
-                    for client_info in fixed_clients:
-                        logger.info(f"  - {client_info}")
-                    return True
+                    # For XHTTP transport - remove flow parameter from all clients
+                    if network == 'xhttp':
+                        for client in clients:
+                            client_id = client.get('id', 'unknown')
+                            client_email = client.get('email', client_id)
+
+                            # Remove flow parameter if present (XHTTP doesn't use it)
+                            if 'flow' in client:
+                                del client['flow']
+                                config_modified = True
+                                fixed_clients.append(f"{client_email} ({client_id[:8]}...) - removed flow")
+                                logger.info(f"✓ Removed 'flow' parameter from user {client_email} in {inbound_tag} (not needed for XHTTP)")
+
+                # Write config if modified
+                if config_modified:
+                    if await self.write_config(config):
+                        logger.info(f"✓ Config validation complete: Fixed {len(fixed_clients)} client(s)")
+                        for client_info in fixed_clients:
+                            logger.info(f"  - {client_info}")
+                        return True
+                    else:
+                        logger.error("Failed to write fixed config")
+                        return False
                 else:
-                    logger.error("Failed to write fixed config")
+                    logger.info("✓ Config validation complete: No issues found")
                     return False
-            else:
-                logger.info("✓ Config validation complete: No issues found")
-                return False
 
         except Exception as e:
             logger.error(f"Error validating config: {e}")
@@ -304,46 +662,50 @@ class XrayConfigManager:
             True if updated successfully, False otherwise
         """
         try:
-            config = await self.read_config()
-            inbounds = config.get('inbounds', [])
-
-            for inbound in inbounds:
-                if inbound.get('tag') == inbound_tag:
-                    # Update SNI in REALITY settings
-                    stream_settings = inbound.get('streamSettings', {})
-                    reality_settings = stream_settings.get('realitySettings', {})
-
-                    current_sni = reality_settings.get('serverNames', [])
-                    if current_sni and len(current_sni) > 0:
-                        current_sni = current_sni[0]
-                    else:
-                        current_sni = None
+            async with self._config_lock:
+                config = await self.read_config()
+                inbound = self._inbound(config, inbound_tag)
+                if inbound is None:
+                    logger.error(f"Inbound {inbound_tag} not found in config")
+                    return False
 
-                    if current_sni == new_sni:
-                        logger.info(f"SNI already set to '{new_sni}', no change needed")
-                        return True
+                # Update SNI in REALITY settings
+                stream_settings = inbound.get('streamSettings', {})
+                reality_settings = stream_settings.get('realitySettings', {})
 
-                    # Update serverNames
-                    reality_settings['serverNames'] = [new_sni]
-                    stream_settings['realitySettings'] = reality_settings
-                    inbound['streamSettings'] = stream_settings
+                current_sni = reality_settings.get('serverNames', [])
+                if current_sni and len(current_sni) > 0:
+                    current_sni = current_sni[0]
+                else:
+                    current_sni = None
 
-                    # Write config and reload immediately (SNI change requires restart)
-                    if await self.write_config(config):
-                        logger.info(f"✓ Updated SNI from '{current_sni}' to '{new_sni}', reloading Xray...")
-                        # SNI change requires Xray restart - do it immediately
-                        if await self.reload_xray():
-                            logger.info("✓ Xray reloaded successfully with new SNI")
-                            return True
-                        else:
-                            logger.error("Failed to reload Xray after SNI update")
-                            return False
-                    else:
-                        logger.error("Failed to write config when updating SNI")
-                        return False
+                # Unless an earlier update was cached but never applied
+                if current_sni == new_sni and not self.config_needs_reload:
+                    logger.debug("SNI already set to '%s', no change needed", new_sni)
+                    return True
 
-            logger.error(f"Inbound {inbound_tag} not found in config")
-            return False
+                # Update serverNames
+                reality_settings['serverNames'] = [new_sni]
+                stream_settings['realitySettings'] = reality_settings
+                inbound['streamSettings'] = stream_settings
+
+                self.config_needs_reload = True
+                written = await self.write_config(config)
+
+            # Reload immediately (SNI change requires restart); the lock is
+            # released first so user syncs aren't held up by the restart
+            if written:
+                logger.info(f"✓ Updated SNI from '{current_sni}' to '{new_sni}', reloading Xray...")
+                # SNI change requires Xray restart - do it immediately
+                if await self.reload_xray():
+                    logger.info("✓ Xray reloaded successfully with new SNI")
+                    return True
+                else:
+                    logger.error("Failed to reload Xray after SNI update")
+                    return False
+            else:
+                logger.error("Failed to write config when updating SNI")
+                return False
 
         except Exception as e:
             logger.error(f"Error updating SNI: {e}")
@@ -351,15 +713,44 @@ class XrayConfigManager:
 
 
 class XrayStatsClient:
-    """Client for Xray stats API using CLI"""
-
-    def __init__(self, xray_binary: str = "/usr/local/bin/xray", api_address: str = "127.0.0.1:10085"):
+    """Client for Xray stats API (gRPC, with CLI fallback)"""
+
+    def __init__(
+        self,
+        xray_binary: str = "/usr/local/bin/xray",
+        api_address: str = "127.0.0.1:10085",
+        channel: Optional[grpc.Channel] = None
+    ):
         self.xray_binary = xray_binary
         self.api_address = api_address
+        # Long-lived gRPC channel (shared with XrayConfigManager when given),
+        # otherwise opened on first query and reused afterwards
+        self._channel: Optional[grpc.Channel] = channel
+        self._stub: Optional[stats_pb2_grpc.StatsServiceStub] = None
+        # Invariant part of the CLI fallback argv
+        self._statsquery_cmd = (self.xray_binary, "api", "statsquery", "-s", self.api_address)
+
+    def _get_stub(self) -> stats_pb2_grpc.StatsServiceStub:
+        """Return the stats stub, opening the channel on first use"""
+        if self._stub is None:
+            if self._channel is None:
+                self._channel = grpc.insecure_channel(self.api_address)
+            self._stub = stats_pb2_grpc.StatsServiceStub(self._channel)
+        return self._stub
+
+    async def close(self):
+        """Close the underlying gRPC channel"""
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+            self._stub = None
 
     async def query_stats(self, pattern: str = "", reset: bool = False) -> List[Dict]:
         """
-        Query all stats matching a pattern using Xray CLI
+        Query all stats matching a pattern
+
+        Uses the persistent gRPC channel to the Xray API. Falls back to
+        spawning `xray api statsquery` if the gRPC call fails.
 
         Args:
             pattern: Pattern to match stats names (e.g., "user>>>")
@@ -369,51 +760,52 @@ class XrayStatsClient:
             List of stats dicts with 'name' and 'value' keys
         """
         try:
-            # Build command: xray api statsquery -s 127.0.0.1:10085 -pattern "user>>>" -reset
-            cmd = [
-                self.xray_binary,
-                "api",
-                "statsquery",
-                "-s", self.api_address,
-                "-pattern", pattern
-            ]
+            stub = self._get_stub()
+            # The stub is synchronous - run the call in a worker thread
+            response = await asyncio.to_thread(
+                stub.QueryStats,
+                stats_pb2.QueryStatsRequest(pattern=pattern, reset=reset),
+                timeout=GRPC_TIMEOUT
+            )
+            return [{'name': stat.name, 'value': stat.value} for stat in response.stat if stat.name]
+        except Exception as e:
+            logger.warning(f"gRPC statsquery failed, falling back to CLI: {grpc_error(e)}")
 
-            if reset:
-                cmd.append("-reset")
+        return await self._query_stats_cli(pattern, reset)
 
-            # Run command
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+    async def _query_stats_cli(self, pattern: str, reset: bool) -> List[Dict]:
+        """Query stats by running `xray api statsquery`"""
+        try:
+            # Build command: xray api statsquery -s 127.0.0.1:10085 -pattern "user>>>" -reset
+            cmd = (*self._statsquery_cmd, "-pattern", pattern, *(("-reset",) if reset else ()))
 
-            stdout, stderr = await process.communicate()
+            # Run command
+            returncode, stdout, stderr = await run_command(cmd, CLI_TIMEOUT)
 
-            if process.returncode != 0:
+            if returncode != 0:
                 logger.error(f"Xray statsquery failed: {stderr.decode()}")
                 return []
 
             # Parse JSON output
             # Xray returns JSON format: {"stat": [{"name": "...", "value": 123}, ...]}
             try:
-                data = json.loads(stdout.decode())
-                stats = data.get('stat', [])
-
-                # Filter out stats without values and ensure value is present
-                result = []
-                for stat in stats:
-                    name = stat.get('name', '')
-                    # value may be missing if counter is 0 or not initialized
-                    value = stat.get('value', 0)
-                    if name:
-                        result.append({'name': name, 'value': value})
-
-                return result
-            except json.JSONDecodeError as e:
+                # orjson parses the raw stdout bytes, no intermediate decode
+                data = orjson.loads(stdout)
+
+                # Skip stats without a name; value may be missing if counter
+                # is 0 or not initialized
+                return [
+                    {'name': stat['name'], 'value': stat.get('value', 0)}
+                    for stat in data.get('stat', [])
+                    if stat.get('name')
+                ]
+            except orjson.JSONDecodeError as e:
                 logger.error(f"Failed to parse JSON from xray statsquery: {e}")
                 return []
 
+        except asyncio.TimeoutError:
+            logger.error(f"Xray statsquery timed out after {CLI_TIMEOUT}s")
+            return []
         except Exception as e:
             logger.error(f"Error querying stats: {e}")
             return []
@@ -431,24 +823,77 @@ class NodeAgent:
         self.health_check_interval = int(os.getenv('HEALTH_CHECK_INTERVAL', '60'))
         self.user_sync_interval = int(os.getenv('USER_SYNC_INTERVAL', '5'))  # seconds - fast sync for instant user activation
         self.inbound_tag = os.getenv('INBOUND_TAG', 'vless-in')  # Xray inbound tag
+        # Main server must accept Content-Encoding: gzip on traffic reports
+        self.traffic_gzip = os.getenv('TRAFFIC_GZIP', 'false').lower() in ('1', 'true', 'yes')
         self.active_users_window = 300  # 5 minutes in seconds
 
         # Xray managers
-        self.xray_stats = XrayStatsClient()
         self.xray_config = XrayConfigManager()
+        # Stats use the same gRPC channel as user management
+        self.xray_stats = XrayStatsClient(
+            api_address=f"{self.xray_config.xray_api_host}:{self.xray_config.xray_api_port}",
+            channel=self.xray_config.xray_channel
+        )
 
         # Track user activity (uuid -> last_activity_timestamp)
         self.user_last_activity: Dict[str, float] = {}
+        # Parsed traffic stat names (name -> (uuid, direction index))
+        self._stat_names: Dict[str, Tuple[str, int]] = {}
+
+        # Traffic read (and reset) from Xray but not yet accepted by main
+        # server (uuid -> [upload, download])
+        self._unsent_traffic: Dict[str, List[int]] = {}
+
+        # Prime CPU sampling: later cpu_percent(None) calls return usage since
+        # the previous call without blocking the event loop
+        psutil.cpu_percent(interval=None)
 
         # Session
         self.session: Optional[aiohttp.ClientSession] = None
+        # Caps concurrent requests so retries from all loops can't pile up
+        self._request_semaphore = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+
+        # ETag of the last user list applied by sync_users, valid while the
+        # config manager's epoch is unchanged
+        self._users_etag: Optional[str] = None
+        self._users_etag_epoch = 0
+        self._users_sync_count = 0
+
+        # Xray restart requested via SIGHUP
+        self._reload_task: Optional[asyncio.Task] = None
+
+        # Main server endpoints for this node (built once node_id is known)
+        self._node_url = ""
+        self._traffic_url = ""
+        self._health_url = ""
+        self._users_url = ""
+        if self.node_id:
+            self._build_endpoints()
+
+    def _build_endpoints(self):
+        """Precompute per-node main server URLs"""
+        self._node_url = f"{self.main_server_url}/api/v1/nodes/{self.node_id}"
+        self._traffic_url = f"{self._node_url}/traffic"
+        self._health_url = f"{self._node_url}/health"
+        self._users_url = f"{self._node_url}/users"
 
     async def start(self):
         """Start the node agent"""
         logger.info("Starting Node Agent...")
 
-        # Create aiohttp session
+        # Create aiohttp session; all loops talk to the same host, so keep a
+        # small pool of warm keep-alive connections instead of reconnecting
+        connector = aiohttp.TCPConnector(
+            limit=16,
+            limit_per_host=8,
+            keepalive_timeout=75,
+            ttl_dns_cache=300
+        )
+        # Bound every request so a stalled main server can't wedge a loop
+        timeout = aiohttp.ClientTimeout(total=30, connect=5)
         self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
             headers={
                 'X-API-Key': self.api_key,
                 'Content-Type': 'application/json'
@@ -463,6 +908,14 @@ class NodeAgent:
         if not self.node_id:
             await self.register_node()
 
+        # Stop on SIGINT/SIGTERM (docker stop) instead of relying on KeyboardInterrupt
+        loop = asyncio.get_running_loop()
+        stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        # SIGHUP (docker kill --signal=HUP): restart Xray now, e.g. after a manual config edit
+        loop.add_signal_handler(signal.SIGHUP, self._request_reload)
+
         # Start background tasks
         tasks = [
             asyncio.create_task(self.sync_traffic_loop()),
@@ -470,14 +923,30 @@ class NodeAgent:
             asyncio.create_task(self.sync_users_loop()),
             asyncio.create_task(self.sync_sni_loop()),
             # reload_xray_loop removed - no longer needed with gRPC API for user management
+            asyncio.create_task(stop_event.wait()),
         ]
 
         try:
-            await asyncio.gather(*tasks)
-        except KeyboardInterrupt:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
             logger.info("Shutting down...")
         finally:
+            if self._reload_task is not None:
+                tasks.append(self._reload_task)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.xray_config.flush()
             await self.session.close()
+            await self.xray_stats.close()
+
+    def _request_reload(self):
+        """SIGHUP handler: restart Xray in the background, one restart at a time"""
+        if self._reload_task is not None and not self._reload_task.done():
+            logger.info("SIGHUP: Xray restart already in progress")
+            return
+
+        logger.info("SIGHUP received, restarting Xray...")
+        self._reload_task = asyncio.create_task(self.xray_config.reload_xray())
 
     async def register_node(self):
         """Register node with main server"""
@@ -499,13 +968,14 @@ class NodeAgent:
         }
 
         try:
-            async with self.session.post(
+            async with self._request_semaphore, self.session.post(
                 f"{self.main_server_url}/api/v1/nodes/register",
-                json=node_info
+                data=orjson.dumps(node_info)
             ) as resp:
                 if resp.status == 200:
-                    data = await resp.json()
+                    data = orjson.loads(await resp.read())
                     self.node_id = data.get('id')
+                    self._build_endpoints()
                     logger.info(f"✓ Registered as node {self.node_id}")
                 else:
                     logger.error(f"Failed to register node: {resp.status}")
@@ -516,90 +986,134 @@ class NodeAgent:
         """Periodically sync traffic stats with main server"""
         logger.info(f"Starting traffic sync loop (interval: {self.sync_interval}s)")
 
+        failures = 0
         while True:
             try:
                 await self.sync_traffic()
-                await asyncio.sleep(self.sync_interval)
+                failures = 0
+                await asyncio.sleep(jittered(self.sync_interval))
             except Exception as e:
-                logger.error(f"Error in traffic sync loop: {e}")
-                await asyncio.sleep(self.sync_interval)
+                failures += 1
+                delay = backoff(self.sync_interval, failures)
+                logger.error(f"Error in traffic sync loop: {e!r}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
 
     async def sync_traffic(self):
-        """Sync traffic statistics to main server using Xray CLI"""
+        """Sync traffic statistics to main server using Xray stats API"""
         if not self.node_id:
             logger.warning("Node not registered, skipping traffic sync")
             return
 
-        # Query all user stats using CLI
-        stats = await self.xray_stats.query_stats(pattern="user>>>", reset=True)
+        # Query all user stats over gRPC
+        stats = await self.xray_stats.query_stats(pattern=USER_STAT_PREFIX, reset=True)
 
-        if not stats:
+        if not stats and not self._unsent_traffic:
             logger.debug("No traffic stats to sync")
             return
 
-        # Parse stats
-        user_traffic = {}
-        current_time = datetime.utcnow().timestamp()
+        # Parse stats (uuid -> [upload, download])
+        user_traffic: Dict[str, List[int]] = {}
+        current_time = time.monotonic()
 
         for stat in stats:
-            name = stat.get('name', '')
             value = stat.get('value', 0)
-
-            # Parse: user>>>UUID>>>traffic>>>uplink or downlink
-            parts = name.split('>>>')
-            if len(parts) != 4 or parts[0] != 'user':
+            # Counters are reset on every query, so each value is already the
+            # delta since the last sync - users without traffic are not sent
+            if not value:
                 continue
 
-            user_uuid = parts[1]
-            direction = parts[3]  # uplink or downlink
-
-            if user_uuid not in user_traffic:
-                user_traffic[user_uuid] = {'upload': 0, 'download': 0}
-
-            if direction == 'uplink':
-                user_traffic[user_uuid]['upload'] = value
-            elif direction == 'downlink':
-                user_traffic[user_uuid]['download'] = value
-
-            # Update last activity timestamp if user has any traffic
-            if value > 0:
-                self.user_last_activity[user_uuid] = current_time
+            # Stat names are stable across polls - parse each one only once
+            name = stat.get('name', '')
+            parsed = self._stat_names.get(name)
+            if parsed is None:
+                parsed = parse_user_stat_name(name)
+                if parsed is None:
+                    continue
+                self._stat_names[name] = parsed
+
+            user_uuid, index = parsed
+            counters = user_traffic.get(user_uuid)
+            if counters is None:
+                counters = user_traffic[user_uuid] = [0, 0]
+            counters[index] = value
+
+            # Update last activity timestamp (user has traffic)
+            self.user_last_activity[user_uuid] = current_time
+
+        # Add traffic from previous syncs the server never acknowledged
+        for user_uuid, (upload, download) in self._unsent_traffic.items():
+            counters = user_traffic.get(user_uuid)
+            if counters is None:
+                user_traffic[user_uuid] = [upload, download]
+            else:
+                counters[0] += upload
+                counters[1] += download
 
         # Send to main server
         if user_traffic:
             payload = {
                 'node_id': self.node_id,
-                'timestamp': datetime.utcnow().isoformat(),
-                'user_traffic': user_traffic
+                'timestamp': utc_now(),  # orjson emits the same ISO 8601 string
+                'user_traffic': {
+                    user_uuid: {'upload': upload, 'download': download}
+                    for user_uuid, (upload, download) in user_traffic.items()
+                }
             }
 
-            # Log traffic data for debugging
-            total_bytes = sum(t['upload'] + t['download'] for t in user_traffic.values())
-            logger.info(f"Syncing {len(user_traffic)} users, total: {total_bytes} bytes, data: {user_traffic}")
+            # Log traffic summary; the per-user dump only at DEBUG level
+            total_bytes = sum(upload + download for upload, download in user_traffic.values())
+            logger.info("Syncing %d users, total: %d bytes", len(user_traffic), total_bytes)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Traffic data: %r", user_traffic)
 
+            # Repeated keys and UUIDs compress well: gzip large bodies (opt-in)
+            body = orjson.dumps(payload)
+            headers = None
+            if self.traffic_gzip and len(body) > GZIP_MIN_SIZE:
+                body = gzip.compress(body)
+                headers = {'Content-Encoding': 'gzip'}
+
+            delivered = False
             try:
-                async with self.session.post(
-                    f"{self.main_server_url}/api/v1/nodes/{self.node_id}/traffic",
-                    json=payload
+                async with self._request_semaphore, self.session.post(
+                    self._traffic_url,
+                    data=body,
+                    headers=headers
                 ) as resp:
                     if resp.status == 200:
-                        logger.info(f"✓ Synced traffic for {len(user_traffic)} users")
+                        delivered = True
+                        logger.info("✓ Synced traffic for %d users", len(user_traffic))
+                    elif headers is not None and resp.status in (400, 415):
+                        # Server doesn't take gzip bodies - the kept traffic
+                        # goes out uncompressed with the next sync
+                        self.traffic_gzip = False
+                        logger.warning(f"Main server rejected gzip traffic body ({resp.status}), disabling TRAFFIC_GZIP")
                     else:
                         logger.warning(f"Failed to sync traffic: {resp.status}")
+            except TRANSIENT_ERRORS:
+                raise
             except Exception as e:
                 logger.error(f"Error syncing traffic: {e}")
+            finally:
+                # Xray counters are already reset - keep undelivered traffic
+                # so it is retried with the next sync instead of lost
+                self._unsent_traffic = {} if delivered else user_traffic
 
     async def health_check_loop(self):
         """Periodically send health check to main server"""
         logger.info(f"Starting health check loop (interval: {self.health_check_interval}s)")
 
+        failures = 0
         while True:
             try:
                 await self.send_health_check()
-                await asyncio.sleep(self.health_check_interval)
+                failures = 0
+                await asyncio.sleep(jittered(self.health_check_interval))
             except Exception as e:
-                logger.error(f"Error in health check loop: {e}")
-                await asyncio.sleep(self.health_check_interval)
+                failures += 1
+                delay = backoff(self.health_check_interval, failures)
+                logger.error(f"Error in health check loop: {e!r}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
 
     async def send_health_check(self):
         """Send health check and system stats to main server"""
@@ -607,36 +1121,42 @@ class NodeAgent:
             logger.warning("Node not registered, skipping health check")
             return
 
-        # Get system stats
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        network = psutil.net_io_counters()
-
-        # Count active VPN users (users with traffic in last 5 minutes)
-        current_time = datetime.utcnow().timestamp()
-        active_connections = sum(
-            1 for last_activity in self.user_last_activity.values()
-            if (current_time - last_activity) <= self.active_users_window
-        )
+        # Get system stats (CPU usage since previous health check); the /proc
+        # reads run in one worker thread hop so they don't stall the event loop
+        cpu_percent, memory_percent = await asyncio.to_thread(collect_system_stats)
+
+        # Count active VPN users (users with traffic in last 5 minutes);
+        # entries that fell out of the window are dropped so the map only
+        # ever holds active users and the count is just its size
+        current_time = time.monotonic()
+        cutoff = current_time - self.active_users_window
+        self.user_last_activity = {
+            user_uuid: last_activity
+            for user_uuid, last_activity in self.user_last_activity.items()
+            if last_activity >= cutoff
+        }
+        active_connections = len(self.user_last_activity)
 
         payload = {
             'node_id': self.node_id,
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': utc_now(),
             'cpu_usage': cpu_percent,
-            'memory_usage': memory.percent,
+            'memory_usage': memory_percent,
             'active_connections': active_connections,
             'is_healthy': True
         }
 
         try:
-            async with self.session.post(
-                f"{self.main_server_url}/api/v1/nodes/{self.node_id}/health",
-                json=payload
+            async with self._request_semaphore, self.session.post(
+                self._health_url,
+                data=orjson.dumps(payload)
             ) as resp:
                 if resp.status == 200:
                     logger.debug("✓ Health check sent successfully")
                 else:
                     logger.warning(f"Failed to send health check: {resp.status}")
+        except TRANSIENT_ERRORS:
+            raise
         except Exception as e:
             logger.error(f"Error sending health check: {e}")
 
@@ -646,14 +1166,20 @@ class NodeAgent:
 
         # Initial sync after short delay
         await asyncio.sleep(2)  # Wait for registration to complete
+        # Spread first syncs of nodes that booted together
+        await asyncio.sleep(random.uniform(0, self.user_sync_interval))
 
+        failures = 0
         while True:
             try:
                 await self.sync_users()
-                await asyncio.sleep(self.user_sync_interval)
+                failures = 0
+                await asyncio.sleep(jittered(self.user_sync_interval))
             except Exception as e:
-                logger.error(f"Error in user sync loop: {e}")
-                await asyncio.sleep(self.user_sync_interval)
+                failures += 1
+                delay = backoff(self.user_sync_interval, failures)
+                logger.error(f"Error in user sync loop: {e!r}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
 
     async def sync_users(self):
         """Sync users from main server and update Xray configuration"""
@@ -662,61 +1188,69 @@ class NodeAgent:
             return
 
         try:
-            # Get user list from main server
-            async with self.session.get(
-                f"{self.main_server_url}/api/v1/nodes/{self.node_id}/users"
+            # Forget the ETag if the local config changed behind our back
+            # (external edit, failed save) and on every Nth sync regardless
+            await self.xray_config.read_config()
+            self._users_sync_count += 1
+            if self.xray_config.epoch != self._users_etag_epoch \
+                    or self._users_sync_count % USERS_FULL_SYNC_EVERY == 0:
+                self._users_etag = None
+
+            # Get user list from main server (conditional on the last ETag)
+            headers = {'If-None-Match': self._users_etag} if self._users_etag else None
+            async with self._request_semaphore, self.session.get(
+                self._users_url,
+                headers=headers
             ) as resp:
+                if resp.status == 304:
+                    logger.debug("User sync: user list not modified")
+                    return
+
                 if resp.status != 200:
                     logger.error(f"Failed to get users from server: {resp.status}")
                     return
 
-                data = await resp.json()
+                data = orjson.loads(await resp.read())
                 server_users = data.get('users', [])
+                etag = resp.headers.get('ETag')
 
             # Build set of UUIDs from server
-            server_uuids: Set[str] = set()
-            server_user_map: Dict[str, Dict] = {}  # uuid -> user data
-
-            for user in server_users:
-                uuid = user.get('uuid')
-                if uuid:
-                    server_uuids.add(uuid)
-                    server_user_map[uuid] = user
+            server_uuids: Set[str] = {user['uuid'] for user in server_users if user.get('uuid')}
 
             # Get current users from Xray config
             current_uuids = await self.xray_config.get_inbound_users(self.inbound_tag)
 
-            # Add new users
-            users_to_add = server_uuids - current_uuids
-            added_count = 0
-            for uuid in users_to_add:
-                user_data = server_user_map[uuid]
-                # Use UUID as email for traffic tracking
-                email = uuid
-
-                if await self.xray_config.add_user(
-                    inbound_tag=self.inbound_tag,
-                    user_uuid=uuid,
-                    email=email
-                ):
-                    added_count += 1
-
-            # Remove users no longer on server
-            users_to_remove = current_uuids - server_uuids
-            removed_count = 0
-            for uuid in users_to_remove:
-                if await self.xray_config.remove_user(
-                    inbound_tag=self.inbound_tag,
-                    user_uuid=uuid
-                ):
-                    removed_count += 1
+            # Diff in a single pass per side (UUID is used as email for traffic tracking)
+            users_to_add = [(uuid, uuid) for uuid in server_uuids if uuid not in current_uuids]
+            users_to_remove = [uuid for uuid in current_uuids if uuid not in server_uuids]
+
+            # Add new users and remove users no longer on server in one diff
+            added_count, removed_count = await self.xray_config.apply_user_diff(
+                inbound_tag=self.inbound_tag,
+                users_to_add=users_to_add,
+                user_uuids_to_remove=users_to_remove
+            )
+
+            # Removed users' stat names won't be seen again
+            for user_uuid in users_to_remove:
+                for direction in TRAFFIC_DIRECTIONS:
+                    self._stat_names.pop(f"{USER_STAT_PREFIX}{user_uuid}{TRAFFIC_STAT_INFIX}{direction}", None)
+
+            # Only skip future diffs once this list has been fully applied
+            if added_count == len(users_to_add) and removed_count == len(users_to_remove):
+                self._users_etag = etag
+                self._users_etag_epoch = self.xray_config.epoch
+            else:
+                self._users_etag = None
 
             # Log results
             if added_count > 0 or removed_count > 0:
                 logger.info(f"✓ User sync complete: added {added_count}, removed {removed_count}, total {len(current_uuids) + added_count - removed_count}")
             else:
-                logger.debug(f"User sync: no changes (total users: {len(current_uuids)})")
+                logger.debug("User sync: no changes (total users: %d)", len(current_uuids))
 
+        except TRANSIENT_ERRORS:
+            raise
         except Exception as e:
             logger.error(f"Error syncing users: {e}")
 
@@ -728,13 +1262,17 @@ class NodeAgent:
         # Wait a bit before first check
         await asyncio.sleep(30)
 
+        failures = 0
         while True:
             try:
                 await self.sync_sni()
+                failures = 0
                 await asyncio.sleep(sync_interval)
             except Exception as e:
-                logger.error(f"Error in SNI sync loop: {e}")
-                await asyncio.sleep(sync_interval)
+                failures += 1
+                delay = backoff(sync_interval, failures)
+                logger.error(f"Error in SNI sync loop: {e!r}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
 
     async def sync_sni(self):
         """Sync SNI from main server and update Xray config if changed"""
@@ -744,23 +1282,26 @@ class NodeAgent:
 
         try:
             # Get node info from main server
-            async with self.session.get(
-                f"{self.main_server_url}/api/v1/nodes/{self.node_id}"
+            async with self._request_semaphore, self.session.get(
+                self._node_url
             ) as resp:
                 if resp.status != 200:
                     logger.error(f"Failed to get node info: {resp.status}")
                     return
 
-                node_data = await resp.json()
-                server_sni = node_data.get('sni')
+                node_data = orjson.loads(await resp.read())
 
-                if not server_sni:
-                    logger.debug("No SNI set on server")
-                    return
+            server_sni = node_data.get('sni')
+
+            if not server_sni:
+                logger.debug("No SNI set on server")
+                return
 
-                # Update SNI in config
-                await self.xray_config.update_sni(server_sni, self.inbound_tag)
+            # Update SNI in config (outside the request: may restart Xray)
+            await self.xray_config.update_sni(server_sni, self.inbound_tag)
 
+        except TRANSIENT_ERRORS:
+            raise
         except Exception as e:
             logger.error(f"Error syncing SNI: {e}")
 
@@ -772,4 +1313,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
\ No newline at end of file
@@ -2,129 +2,233 @@
 """
 Script to add user to Xray configuration
 """
-import json
 import sys
 import uuid
 from pathlib import Path
+from typing import List, Optional, Tuple
 
+from config_io import dump_json, index_inbounds, parse_json, write_atomic
 
-def add_user_to_config(config_path: str, user_uuid: str, email: str = None):
+
+def normalize_uuids(user_uuids: List[str]) -> List[str]:
     """
-    Add a user to Xray configuration
+    Validate UUIDs and return them in canonical lowercase form
 
-    Args:
-        config_path: Path to Xray config file
-        user_uuid: User UUID
-        email: Optional email/identifier for the user
+    Runs before the config is loaded, so a typo fails fast and duplicate
+    checks aren't fooled by case. Exits if any UUID is invalid.
     """
+    normalized = []
+    invalid = []
+    for user_uuid in user_uuids:
+        try:
+            normalized.append(str(uuid.UUID(user_uuid)))
+        except ValueError:
+            invalid.append(user_uuid)
+
+    if invalid:
+        for user_uuid in invalid:
+            print(f"Error: Invalid UUID: {user_uuid}")
+        sys.exit(1)
+
+    return normalized
+
+
+def canonical_id(client_id) -> str:
+    """Canonical lowercase form of a config client id (unchanged if not a UUID)"""
+    try:
+        return str(uuid.UUID(client_id))
+    except (ValueError, TypeError, AttributeError):
+        return client_id
+
+
+def load_config(config_path: str) -> dict:
+    """Load Xray config, exit if it doesn't exist"""
     config_file = Path(config_path)
 
     if not config_file.exists():
         print(f"Error: Config file not found: {config_path}")
         sys.exit(1)
 
-    # Load config
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    return parse_json(config_file.read_bytes())
+
 
-    # Find VLESS inbound
-    vless_inbound = None
-    for inbound in config.get('inbounds', []):
-        if inbound.get('protocol') == 'vless':
-            vless_inbound = inbound
-            break
+def save_config(config_path: str, config: dict, pretty: bool = True):
+    """Save Xray config"""
+    write_atomic(config_path, dump_json(config, pretty))
 
-    if not vless_inbound:
+
+def find_vless_inbound(config: dict) -> dict:
+    """Return the first VLESS inbound, exit if there is none"""
+    vless_inbounds = index_inbounds(config)['vless']
+    if not vless_inbounds:
         print("Error: No VLESS inbound found in config")
         sys.exit(1)
+    return vless_inbounds[0]
 
-    # Check if user already exists
-    clients = vless_inbound.get('settings', {}).get('clients', [])
-    for client in clients:
-        if client.get('id') == user_uuid:
+
+def add_users_to_config(
+    config_path: str,
+    users: List[Tuple[str, Optional[str]]],
+    pretty: bool = True
+) -> int:
+    """
+    Add users to Xray configuration with a single load and save
+
+    Args:
+        config_path: Path to Xray config file
+        users: List of (uuid, email) pairs, email may be None
+        pretty: Write indented JSON (False: compact)
+
+    Returns:
+        Number of users added
+    """
+    uuids = normalize_uuids([user_uuid for user_uuid, _ in users])
+    users = [(user_uuid, email) for user_uuid, (_, email) in zip(uuids, users)]
+
+    config = load_config(config_path)
+    vless_inbound = find_vless_inbound(config)
+
+    clients = vless_inbound.setdefault('settings', {}).setdefault('clients', [])
+    existing_ids = {canonical_id(c.get('id')) for c in clients}
+    added = 0
+
+    for user_uuid, email in users:
+        # Check if user already exists
+        if user_uuid in existing_ids:
             print(f"User {user_uuid} already exists")
-            return
+            continue
 
-    # Add new user
-    new_client = {
-        "id": user_uuid,
-        "flow": "xtls-rprx-vision",
-        "level": 0
-    }
+        # Add new user
+        new_client = {
+            "id": user_uuid,
+            "flow": "xtls-rprx-vision",
+            "level": 0
+        }
 
-    if email:
-        new_client['email'] = email
+        if email:
+            new_client['email'] = email
 
-    clients.append(new_client)
-    vless_inbound['settings']['clients'] = clients
+        clients.append(new_client)
+        existing_ids.add(user_uuid)
+        added += 1
 
-    # Save config
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
+        print(f"✓ Added user {user_uuid}")
+        if email:
+            print(f"  Email: {email}")
 
-    print(f"✓ Added user {user_uuid}")
-    if email:
-        print(f"  Email: {email}")
+    # Save config once for the whole batch
+    if added:
+        save_config(config_path, config, pretty)
 
+    return added
 
-def remove_user_from_config(config_path: str, user_uuid: str):
+
+def remove_users_from_config(config_path: str, user_uuids: List[str], pretty: bool = True) -> int:
     """
-    Remove a user from Xray configuration
+    Remove users from Xray configuration with a single load and save
 
     Args:
         config_path: Path to Xray config file
-        user_uuid: User UUID to remove
+        user_uuids: User UUIDs to remove
+        pretty: Write indented JSON (False: compact)
+
+    Returns:
+        Number of users removed
     """
-    config_file = Path(config_path)
+    user_uuids = normalize_uuids(user_uuids)
 
-    if not config_file.exists():
-        print(f"Error: Config file not found: {config_path}")
-        sys.exit(1)
+    config = load_config(config_path)
+    vless_inbound = find_vless_inbound(config)
 
-    # Load config
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    clients = vless_inbound.get('settings', {}).get('clients', [])
+    existing_ids = {canonical_id(c.get('id')) for c in clients}
 
-    # Find VLESS inbound
-    vless_inbound = None
-    for inbound in config.get('inbounds', []):
-        if inbound.get('protocol') == 'vless':
-            vless_inbound = inbound
-            break
+    to_remove = set()
+    for user_uuid in user_uuids:
+        if user_uuid in existing_ids:
+            to_remove.add(user_uuid)
+            print(f"✓ Removed user {user_uuid}")
+        else:
+            print(f"User {user_uuid} not found")
 
-    if not vless_inbound:
-        print("Error: No VLESS inbound found in config")
-        sys.exit(1)
+    # Remove users in one pass, no list rebuild when none are present
+    if not to_remove:
+        return 0
 
-    # Remove user
-    clients = vless_inbound.get('settings', {}).get('clients', [])
-    new_clients = [c for c in clients if c.get('id') != user_uuid]
+    clients[:] = [c for c in clients if canonical_id(c.get('id')) not in to_remove]
 
-    if len(clients) == len(new_clients):
-        print(f"User {user_uuid} not found")
-        return
+    save_config(config_path, config, pretty)
+    return len(to_remove)
 
-    vless_inbound['settings']['clients'] = new_clients
 
-    # Save config
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
+def add_user_to_config(config_path: str, user_uuid: str, email: str = None):
+    """
+    Add a user to Xray configuration
 
-    print(f"✓ Removed user {user_uuid}")
+    Args:
+        config_path: Path to Xray config file
+        user_uuid: User UUID
+        email: Optional email/identifier for the user
+    """
+    add_users_to_config(config_path, [(user_uuid, email)])
+
+
+def remove_user_from_config(config_path: str, user_uuid: str):
+    """
+    Remove a user from Xray configuration
+
+    Args:
+        config_path: Path to Xray config file
+        user_uuid: User UUID to remove
+    """
+    remove_users_from_config(config_path, [user_uuid])
+
+
+def read_batch_file(batch_path: str) -> List[Tuple[str, Optional[str]]]:
+    """Read `uuid[,email]` lines (blank lines and # comments are skipped)"""
+    users = []
+    with open(batch_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            user_uuid, _, email = line.partition(',')
+            users.append((user_uuid.strip(), email.strip() or None))
+    return users
 
 
 if __name__ == "__main__":
+    # --compact may appear anywhere: write minified JSON instead of indented
+    pretty = '--compact' not in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--compact']
+
     if len(sys.argv) < 3:
         print("Usage:")
-        print("  Add user:    python add_user.py /path/to/config.json <uuid> [email]")
-        print("  Remove user: python add_user.py /path/to/config.json <uuid> --remove")
+        print("  Add user:     python add_user.py /path/to/config.json <uuid> [email]")
+        print("  Remove user:  python add_user.py /path/to/config.json <uuid> --remove")
+        print("  Add batch:    python add_user.py /path/to/config.json --batch users.txt")
+        print("  Remove batch: python add_user.py /path/to/config.json --batch users.txt --remove")
+        print("  (batch file: one `uuid[,email]` per line)")
+        print("  Add --compact to write minified JSON instead of indented")
         sys.exit(1)
 
     config_path = sys.argv[1]
+
+    if sys.argv[2] == '--batch':
+        if len(sys.argv) < 4:
+            print("Error: --batch requires a file")
+            sys.exit(1)
+        users = read_batch_file(sys.argv[3])
+        if len(sys.argv) > 4 and sys.argv[4] == '--remove':
+            remove_users_from_config(config_path, [user_uuid for user_uuid, _ in users], pretty)
+        else:
+            add_users_to_config(config_path, users, pretty)
+        sys.exit(0)
+
     user_uuid = sys.argv[2]
 
     if len(sys.argv) > 3 and sys.argv[3] == '--remove':
-        remove_user_from_config(config_path, user_uuid)
+        remove_users_from_config(config_path, [user_uuid], pretty)
     else:
         email = sys.argv[3] if len(sys.argv) > 3 else None
-        add_user_to_config(config_path, user_uuid, email)
+        add_users_to_config(config_path, [(user_uuid, email)], pretty)
@@ -0,0 +1,111 @@
+"""
+Shared config helpers for the host-side scripts
+
+Loading, dumping and atomically replacing the Xray config, plus the
+inbound-by-protocol index. Imported by add_user.py, migrate_to_xhttp.py
+and update_config_stability.py (run from this directory).
+"""
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+try:
+    import orjson  # optional: much faster load/dump of large configs
+except ImportError:
+    orjson = None
+
+
+def parse_json(data: bytes) -> dict:
+    """Parse config JSON (orjson when installed, stdlib json otherwise)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(config: dict, pretty: bool = True) -> bytes:
+    """Serialize config, 2-space indented or compact (orjson when installed, stdlib json otherwise)"""
+    if orjson is not None:
+        return orjson.dumps(config, option=orjson.OPT_INDENT_2 if pretty else None)
+    if pretty:
+        return json.dumps(config, indent=2).encode()
+    return json.dumps(config, separators=(',', ':')).encode()
+
+
+def backup_config(config_path, backup_path) -> bool:
+    """
+    Save the current config as backup_path, replacing an older backup
+
+    Hardlinks when possible, so a large config isn't copied. The config is
+    also rewritten in place (xray_config.sh apply/reset, manual edits), so
+    a linked backup only keeps the old contents once write_atomic() has
+    renamed a new file over the config - back up via
+    write_atomic(backup_path=...) rather than calling this directly.
+
+    Returns:
+        True if the backup is a hardlink to the live config
+    """
+    if os.path.lexists(backup_path):
+        os.unlink(backup_path)
+    try:
+        os.link(config_path, backup_path)
+        return True
+    except OSError:
+        shutil.copy2(config_path, backup_path)
+        return False
+
+
+def write_atomic(config_path, data: bytes, backup_path=None):
+    """
+    Replace the config file atomically
+
+    Writes a temp file in the same directory and renames it over the
+    original, so Xray never sees a half-written config. Keeps the file mode.
+    The temp file is removed if any step fails (e.g. ENOSPC on write).
+
+    With backup_path the current config is backed up (see backup_config)
+    right before the rename; a linked backup is removed again if the
+    rename fails, so it never shares the live file.
+    """
+    config_file = Path(config_path)
+    linked = False
+    tmp = tempfile.NamedTemporaryFile('wb', dir=config_file.parent, prefix=f".{config_file.name}.", delete=False)
+    try:
+        with tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        if config_file.exists():
+            shutil.copymode(config_file, tmp.name)
+        else:
+            os.chmod(tmp.name, 0o644)
+        if backup_path is not None:
+            linked = backup_config(config_file, backup_path)
+        os.replace(tmp.name, config_file)
+    except BaseException:
+        # The config is left as it was: a linked backup of it would share its
+        # inode and change with the next in-place edit
+        leftovers = (tmp.name, backup_path) if linked else (tmp.name,)
+        for path in leftovers:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+def index_inbounds(config: dict) -> Dict[str, List[dict]]:
+    """
+    Group inbounds by protocol
+
+    The lists hold the same dicts as config['inbounds'], so changes made
+    through the index end up in the config.
+    """
+    index = defaultdict(list)
+    for inbound in config.get('inbounds', []):
+        index[inbound.get('protocol')].append(inbound)
+    return index
@@ -16,78 +16,101 @@ Changes:
 5. Update sniffing destOverride to include 'quic'
 
 Usage:
-    python migrate_to_xhttp.py [--dry-run] [--path /custom/path]
+    python migrate_to_xhttp.py [--dry-run] [--path /custom/path] [--quiet] [--compact]
 """
-import json
 import sys
-import shutil
 import argparse
+import time
 from pathlib import Path
-from datetime import datetime
+from typing import Callable, List
+
+from config_io import dump_json, index_inbounds, parse_json, write_atomic
 
 CONFIG_PATH = "/usr/local/etc/xray/config.json"
 DEFAULT_XHTTP_PATH = "/sfkt"
 
+# xhttpSettings written by the migration (path is added per run)
+XHTTP_SETTINGS = {"mode": "auto"}
 
-def backup_config(config_path: str) -> str:
-    """Create timestamped backup of current config"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = f"{config_path}.backup_{timestamp}"
-    shutil.copy2(config_path, backup_path)
-    print(f"✓ Backup created: {backup_path}")
-    return backup_path
+# dict.pop() default that no config value can be
+_MISSING = object()
+
+
+class Reporter:
+    """
+    Collects per-inbound progress messages and writes them in one go
+
+    With quiet=True messages are dropped.
+    """
+
+    def __init__(self, quiet: bool = False):
+        self.lines: List[str] = []
+        if quiet:
+            self.log = lambda *_: None
+
+    def log(self, msg: str = ""):
+        self.lines.append(msg)
 
+    def flush(self):
+        if self.lines:
+            sys.stdout.write("\n".join(self.lines) + "\n")
+            self.lines.clear()
 
-def migrate_inbound_to_xhttp(inbound: dict, xhttp_path: str) -> bool:
+
+def migrate_inbound_to_xhttp(
+    inbound: dict,
+    xhttp_path: str,
+    log: Callable[[str], None] = print
+) -> bool:
     """
     Migrate a VLESS inbound from TCP to XHTTP transport
 
+    Progress messages go to log (print by default, see Reporter)
+
     Returns True if changes were made
     """
     if inbound.get("protocol") != "vless":
         return False
 
-    stream_settings = inbound.get("streamSettings", {})
+    tag = inbound.get('tag', 'unknown')
+    # A missing streamSettings means tcp, which gets migrated anyway
+    stream_settings = inbound.setdefault("streamSettings", {})
     current_network = stream_settings.get("network", "tcp")
 
     # Already using xhttp
     if current_network == "xhttp":
-        print(f"  ℹ Inbound '{inbound.get('tag', 'unknown')}' already using XHTTP")
+        log(f"  ℹ Inbound '{tag}' already using XHTTP")
         return False
 
     # Only migrate TCP transport
     if current_network != "tcp":
-        print(f"  ⚠ Skipping inbound '{inbound.get('tag', 'unknown')}' with network '{current_network}'")
+        log(f"  ⚠ Skipping inbound '{tag}' with network '{current_network}'")
         return False
 
-    tag = inbound.get('tag', 'unknown')
-    print(f"\n  Migrating inbound '{tag}' from TCP to XHTTP...")
+    log(f"\n  Migrating inbound '{tag}' from TCP to XHTTP...")
 
     # 1. Change network to xhttp
     stream_settings["network"] = "xhttp"
-    print(f"    + network: tcp -> xhttp")
+    log(f"    + network: tcp -> xhttp")
 
     # 2. Add xhttpSettings
-    stream_settings["xhttpSettings"] = {
-        "mode": "auto",
-        "path": xhttp_path
-    }
-    print(f"    + xhttpSettings: mode=auto, path={xhttp_path}")
+    stream_settings["xhttpSettings"] = {**XHTTP_SETTINGS, "path": xhttp_path}
+    log(f"    + xhttpSettings: mode=auto, path={xhttp_path}")
 
     # 3. Remove tcpSettings if present
     if "tcpSettings" in stream_settings:
         del stream_settings["tcpSettings"]
-        print(f"    - Removed tcpSettings")
+        log(f"    - Removed tcpSettings")
 
     # 4. Remove sockopt (not needed for XHTTP, can cause issues)
     if "sockopt" in stream_settings:
         del stream_settings["sockopt"]
-        print(f"    - Removed sockopt (not needed for XHTTP)")
+        log(f"    - Removed sockopt (not needed for XHTTP)")
 
     # 5. Update realitySettings.show to false (reduce logs)
     if "realitySettings" in stream_settings:
         stream_settings["realitySettings"]["show"] = False
-        print(f"    + realitySettings.show = false")
+        log(f"    + realitySettings.show = false")
 
     # 6. Update sniffing to include quic
     if "sniffing" in inbound:
@@ -95,9 +118,8 @@ def migrate_inbound_to_xhttp(inbound: dict, xhttp_path: str) -> bool:
         if "quic" not in dest_override:
             dest_override.append("quic")
             inbound["sniffing"]["destOverride"] = dest_override
-            print(f"    + Added 'quic' to sniffing.destOverride")
+            log(f"    + Added 'quic' to sniffing.destOverride")
 
-    inbound["streamSettings"] = stream_settings
     return True
 
 
@@ -108,14 +130,8 @@ def remove_flow_from_clients(inbound: dict) -> int:
     Returns number of clients modified
     """
     clients = inbound.get("settings", {}).get("clients", [])
-    modified_count = 0
-
-    for client in clients:
-        if "flow" in client:
-            del client["flow"]
-            modified_count += 1
-
-    return modified_count
+    # One pop per client, no separate membership test
+    return sum(client.pop("flow", _MISSING) is not _MISSING for client in clients)
 
 
 def update_comment(inbound: dict):
@@ -142,6 +158,16 @@ def main():
         default=DEFAULT_XHTTP_PATH,
         help=f"XHTTP path (default: {DEFAULT_XHTTP_PATH})"
     )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only print the summary, not per-inbound changes"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write minified JSON instead of 2-space indented"
+    )
     parser.add_argument(
         "--config",
         default=CONFIG_PATH,
@@ -165,36 +191,31 @@ def main():
 
     # Read config
     print(f"Reading config from {args.config}...")
-    with open(args.config, 'r') as f:
-        config = json.load(f)
-
-    if not args.dry_run:
-        # Create backup
-        print("\nCreating backup...")
-        backup_config(args.config)
+    config = parse_json(config_path.read_bytes())
 
     # Process inbounds
     print("\nProcessing inbounds...")
     inbounds_modified = 0
     clients_modified = 0
 
-    for inbound in config.get("inbounds", []):
-        if inbound.get("protocol") != "vless":
-            continue
+    reporter = Reporter(quiet=args.quiet)
 
+    for inbound in index_inbounds(config)["vless"]:
         # Migrate transport
-        if migrate_inbound_to_xhttp(inbound, args.path):
+        if migrate_inbound_to_xhttp(inbound, args.path, reporter.log):
             inbounds_modified += 1
 
         # Remove flow from clients
         flow_removed = remove_flow_from_clients(inbound)
         if flow_removed > 0:
             clients_modified += flow_removed
-            print(f"    - Removed 'flow' from {flow_removed} client(s)")
+            reporter.log(f"    - Removed 'flow' from {flow_removed} client(s)")
 
         # Update comment
         update_comment(inbound)
 
+    reporter.flush()
+
     # Summary
     print("\n" + "=" * 60)
     print("Migration Summary")
@@ -211,10 +232,12 @@ def main():
         print("  Run without --dry-run to apply changes")
         return
 
-    # Write updated config
+    # Changes so far are in memory only - the untouched file is backed up
+    # by the write, so idempotent re-runs neither copy nor rewrite anything
+    backup_path = f"{args.config}.backup_{time.strftime('%Y%m%d_%H%M%S')}"
     print(f"\nWriting updated config to {args.config}...")
-    with open(args.config, 'w') as f:
-        json.dump(config, f, indent=2)
+    write_atomic(config_path, dump_json(config, pretty=not args.compact), backup_path)
+    print(f"✓ Backup created: {backup_path}")
 
     print("\n" + "=" * 60)
     print("✓ Migration completed successfully!")
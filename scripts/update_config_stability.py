@@ -5,24 +5,42 @@ Script to update existing Xray config with stability improvements:
 - Add sockopt for TCP keepalive on inbound
 - Add sockopt and settings for outbound
 """
-import json
 import sys
-import shutil
 from pathlib import Path
 
+from config_io import dump_json, parse_json, write_atomic
+
 CONFIG_PATH = "/usr/local/etc/xray/config.json"
 
-def backup_config(config_path: str):
-    """Create backup of current config"""
-    backup_path = f"{config_path}.backup"
-    shutil.copy2(config_path, backup_path)
-    print(f"✓ Backup created: {backup_path}")
-    return backup_path
+# Settings added if missing (copied before insertion into a config)
+POLICY_TIMEOUTS = {
+    "handshake": 8,
+    "connIdle": 600,
+    "uplinkOnly": 5,
+    "downlinkOnly": 10,
+    "bufferSize": 512
+}
+INBOUND_SOCKOPT = {
+    "tcpNoDelay": True,
+    "tcpKeepAliveIdle": 300,
+    "tcpKeepAliveInterval": 30,
+    "tcpUserTimeout": 10000,
+    "tcpFastOpen": False,
+    "mark": 0
+}
+OUTBOUND_SETTINGS = {
+    "domainStrategy": "UseIPv4"
+}
+OUTBOUND_SOCKOPT = {
+    "tcpNoDelay": True,
+    "tcpKeepAliveIdle": 300,
+    "tcpKeepAliveInterval": 30,
+    "tcpFastOpen": False
+}
+
 
 def update_policy(config: dict) -> bool:
     """Add timeout settings to policy"""
-    modified = False
-
     if "policy" not in config:
         config["policy"] = {"levels": {}, "system": {}}
 
@@ -35,21 +53,15 @@ def update_policy(config: dict) -> bool:
     level_0 = config["policy"]["levels"]["0"]
 
     # Add timeout settings if missing
-    updates = {
-        "handshake": 8,
-        "connIdle": 600,
-        "uplinkOnly": 5,
-        "downlinkOnly": 10,
-        "bufferSize": 512
-    }
-
-    for key, value in updates.items():
-        if key not in level_0:
-            level_0[key] = value
-            modified = True
-            print(f"  + Added policy.levels.0.{key} = {value}")
+    missing = {key: value for key, value in POLICY_TIMEOUTS.items() if key not in level_0}
+    if not missing:
+        return False
 
-    return modified
+    level_0.update(missing)
+    for key, value in missing.items():
+        print(f"  + Added policy.levels.0.{key} = {value}")
+
+    return True
 
 def update_inbound_sockopt(config: dict) -> bool:
     """Add sockopt to inbound streamSettings"""
@@ -63,21 +75,11 @@ def update_inbound_sockopt(config: dict) -> bool:
         if inbound.get("protocol") != "vless":
             continue
 
-        if "streamSettings" not in inbound:
-            inbound["streamSettings"] = {}
-
-        stream_settings = inbound["streamSettings"]
+        stream_settings = inbound.setdefault("streamSettings", {})
 
         # Add sockopt if missing
         if "sockopt" not in stream_settings:
-            stream_settings["sockopt"] = {
-                "tcpNoDelay": True,
-                "tcpKeepAliveIdle": 300,
-                "tcpKeepAliveInterval": 30,
-                "tcpUserTimeout": 10000,
-                "tcpFastOpen": False,
-                "mark": 0
-            }
+            stream_settings["sockopt"] = dict(INBOUND_SOCKOPT)
             modified = True
             print(f"  + Added sockopt to inbound '{inbound.get('tag', 'unknown')}'")
 
@@ -97,22 +99,13 @@ def update_outbound_settings(config: dict) -> bool:
 
         # Add settings
         if "settings" not in outbound:
-            outbound["settings"] = {
-                "domainStrategy": "UseIPv4"
-            }
+            outbound["settings"] = dict(OUTBOUND_SETTINGS)
             modified = True
             print(f"  + Added settings to outbound 'direct'")
 
         # Add streamSettings with sockopt
         if "streamSettings" not in outbound:
-            outbound["streamSettings"] = {
-                "sockopt": {
-                    "tcpNoDelay": True,
-                    "tcpKeepAliveIdle": 300,
-                    "tcpKeepAliveInterval": 30,
-                    "tcpFastOpen": False
-                }
-            }
+            outbound["streamSettings"] = {"sockopt": dict(OUTBOUND_SOCKOPT)}
             modified = True
             print(f"  + Added sockopt to outbound 'direct'")
 
@@ -130,12 +123,7 @@ def main():
 
     # Read config
     print(f"\nReading config from {CONFIG_PATH}...")
-    with open(CONFIG_PATH, 'r') as f:
-        config = json.load(f)
-
-    # Backup
-    print("\nCreating backup...")
-    backup_config(CONFIG_PATH)
+    config = parse_json(Path(CONFIG_PATH).read_bytes())
 
     # Apply updates
     print("\nApplying updates...")
@@ -163,10 +151,12 @@ def main():
         print("\n✓ No changes needed, config is already up to date!")
         return
 
-    # Write updated config
+    # Updates so far are in memory only - the untouched file is backed up
+    # by the write, so up-to-date configs are neither copied nor rewritten
+    backup_path = f"{CONFIG_PATH}.backup"
     print(f"\nWriting updated config to {CONFIG_PATH}...")
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump(config, f, indent=2)
+    write_atomic(CONFIG_PATH, dump_json(config), backup_path)
+    print(f"✓ Backup created: {backup_path}")
 
     print("\n" + "=" * 60)
     print("✓ Config updated successfully!")